@@ -7,13 +7,57 @@ from typing import Callable, List, Optional, Union, Tuple
 
 import torch
 import torch.nn.functional as F
-from torch.cuda.amp import custom_bwd, custom_fwd
 from torchvision import transforms
 from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput
 from diffusers.pipelines.stable_diffusion import StableDiffusionPipeline
+from diffusers.models.attention_processor import AttnProcessor2_0
+from diffusers.utils import is_torch_version, is_xformers_available
+from diffusers.utils.torch_utils import is_compiled_module
 
 import math
 
+
+_MAX_T_SCHEDULE = re.compile(r"max_([\d.]+)_(\d+)")
+_MIN_T_SCHEDULE = re.compile(r"min_([\d.]+)_(\d+)")
+
+
+def _prompt_key(prompt):
+    return prompt if prompt is None or isinstance(prompt, str) else tuple(prompt)
+
+
+@torch.jit.script
+def _sds_grad_no_cfg(noise_pred, noise, w, grad_scale: float, nan_guard: bool = True):
+    # SDS gradient of an already combined (or unguided) prediction in one fused elementwise kernel
+    grad = grad_scale * w * (noise_pred - noise)
+    if nan_guard:
+        grad = torch.nan_to_num(grad)
+    return grad
+
+
+@torch.jit.script
+def _sds_grad(noise_pred_uncond, noise_pred_pos, noise, w, guidance_scale: float, grad_scale: float,
+              nan_guard: bool = True):
+    # guidance combine and SDS gradient in one fused elementwise kernel
+    # uncond + guidance_scale * (pos - uncond) without the temporaries
+    noise_pred = torch.lerp(noise_pred_uncond, noise_pred_pos, guidance_scale)
+    return _sds_grad_no_cfg(noise_pred, noise, w, grad_scale, nan_guard)
+
+
+def _sds_loss(latents: torch.Tensor, grad: torch.Tensor):
+    # the guidance math runs in fp32, match the (possibly half precision) latents for the loss
+    grad = grad.to(latents.dtype)
+    # re-parameterization trick:
+    # d(loss)/d(latents) = latents - target = latents - (latents - grad) = grad
+    target = (latents - grad).detach()
+    return 0.5 * F.mse_loss(latents, target, reduction="sum")
+
+
+@torch.jit.script
+def _add_noise(latents, noise, sqrt_alpha_prod, sqrt_one_minus_alpha_prod):
+    # the forward diffusion q(x_t | x_0) of `scheduler.add_noise` in one fused elementwise kernel
+    return sqrt_alpha_prod * latents + sqrt_one_minus_alpha_prod * noise
+
+
 class LSDSPipeline(StableDiffusionPipeline):
     r"""
     Pipeline for text-to-image generation using Stable Diffusion.
@@ -41,6 +85,180 @@ class LSDSPipeline(StableDiffusionPipeline):
     """
     _optional_components = ["safety_checker", "feature_extractor"]
 
+    def __init__(self,
+                 vae,
+                 text_encoder,
+                 tokenizer,
+                 unet,
+                 scheduler,
+                 safety_checker,
+                 feature_extractor,
+                 requires_safety_checker: bool = True):
+        super().__init__(vae, text_encoder, tokenizer, unet, scheduler,
+                         safety_checker, feature_extractor, requires_safety_checker)
+        # the text encoder is frozen, SDS never back-propagates through it
+        self.text_encoder.requires_grad_(False)
+        self.text_encoder.eval()
+        # the vae only passes the SDS gradient back to the images, its weights need no gradient
+        self.vae.requires_grad_(False)
+        # the U-Net is only evaluated in the SDS variants
+        self.unet.requires_grad_(False)
+        # speed-up options, set them before the first SDS step
+        self.compile_unet = torch.cuda.is_available()
+        # bf16 keeps the exponent range of fp32, pre-Ampere GPUs do not support it and fall back to fp16.
+        # set None to run in full precision
+        bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+        self.autocast_dtype = torch.bfloat16 if bf16 else torch.float16
+        # fused attention kernels, `F.scaled_dot_product_attention` or xFormers
+        self.efficient_attention = True
+        # the prompts are fixed during an SDS run, so the text embeddings are encoded only once
+        self._text_emb_cache = {}
+        # the unconditional embedding of the empty negative prompt, keyed by batch size and dtype
+        self._uncond_emb_cache = {}
+        # persistent input buffer of the classifier free guidance batch
+        self._cfg_buf = None
+        # the SDS noise is drawn into a persistent buffer, from `sds_generator` (on the pipeline device) if set
+        self.sds_generator = None
+        self._noise_buf = None
+        # replay the fixed-shape SDS U-Net call from CUDA graphs when the U-Net is not compiled
+        self.cuda_graph_unet = False
+        self._unet_graphs = {}
+        # static input buffers of the compiled U-Net
+        self._unet_static = {}
+        # the number of timesteps sampled per guided SDS step, they share one U-Net call
+        self.sds_num_timesteps = 1
+        # zero the NaN/inf of the SDS gradients, a debug safety net that costs an extra pass over the latents
+        self.nan_guard = False
+        # recompute the vae encoder activations in the SDS backward instead of storing them
+        self.vae_grad_ckpt = True
+        # for convenience
+        self.num_train_timesteps = self.scheduler.config.num_train_timesteps
+        self._num_channels_latents = getattr(self.unet.config, "in_channels", None) or self.unet.in_channels
+        self._alphas_cumprod = None
+        self._sqrt_alphas_cumprod = None
+        self._sqrt_one_minus_alphas_cumprod = None
+        # input augmentations, keyed by image size
+        self._augments = {}
+        # parsed `t_schedule`, see `schedule_timestep`
+        self._t_sched = None
+        # device-dependent states are built lazily, see `_prepare_sds`
+        self._sds_prepared = False
+        self._cached_device = None
+
+    def to(self, *args, **kwargs):
+        self._sds_prepared = False
+        self._cached_device = None
+        self._unet_graphs = {}
+        self._unet_static = {}
+        self._text_emb_cache = {}
+        self._uncond_emb_cache = {}
+        return super().to(*args, **kwargs)
+
+    @property
+    def _device(self):
+        # `self.device` walks over all the components, look it up once
+        if self._cached_device is None:
+            self._cached_device = self.device
+        return self._cached_device
+
+    def _prepare_sds(self):
+        if self._sds_prepared:
+            return
+
+        self._alphas_cumprod = self.scheduler.alphas_cumprod.to(self._device, non_blocking=True)
+        self._sqrt_alphas_cumprod = self._alphas_cumprod.sqrt()
+        self._sqrt_one_minus_alphas_cumprod = (1 - self._alphas_cumprod).sqrt()
+
+        if self.efficient_attention and not is_compiled_module(self.unet):
+            if is_torch_version(">=", "2.0.0"):
+                self.unet.set_attn_processor(AttnProcessor2_0())
+                # the mid-block attention of the vae runs at the full latent resolution
+                self.vae.set_attn_processor(AttnProcessor2_0())
+                print(f"=> enable scaled dot product attention")
+            elif is_xformers_available():
+                self.enable_xformers_memory_efficient_attention()
+                print(f"=> enable xformers")
+            else:
+                print(f"=> warning: xformers is not available.")
+            self.efficient_attention = False
+
+        # NHWC layout enables the faster cuDNN convolutions, it pairs well with bf16 and torch.compile
+        self.unet.to(memory_format=torch.channels_last)
+        self.vae.to(memory_format=torch.channels_last)
+
+        if self.vae_grad_ckpt and not is_compiled_module(self.vae.encoder):
+            self.vae.enable_gradient_checkpointing()
+            # diffusers only checkpoints in training mode, the encoder has neither dropout nor batch norm
+            self.vae.encoder.train()
+
+        # torch.compile, the shapes are fixed across SDS steps, so it only compiles once
+        if self.compile_unet and self._device.type == "cuda" and not is_compiled_module(self.unet):
+            if is_torch_version(">=", "2.0.0"):
+                self.unet = torch.compile(self.unet, mode="reduce-overhead", fullgraph=True)
+                # the encoder is differentiated through in SDS, so keep the default mode here
+                self.vae.encoder = torch.compile(self.vae.encoder)
+                self.vae.decoder = torch.compile(self.vae.decoder)
+                print(f"=> enable torch.compile on U-Net and VAE")
+            else:
+                print(f"=> warning: calling torch.compile speed-up failed, since torch version <= 2.0.0")
+
+        self._sds_prepared = True
+
+    def _cfg_input(self, latents: torch.Tensor, n: int = 2):
+        """repeat `latents` n times along the batch dim into a persistent buffer instead of `torch.cat`"""
+        shape = (n * latents.shape[0], *latents.shape[1:])
+        buf = self._cfg_buf
+        # inference tensors can only be written in inference mode, and vice versa for normal tensors
+        if buf is None or buf.shape != shape or buf.dtype != latents.dtype or buf.device != latents.device \
+                or buf.is_inference() != torch.is_inference_mode_enabled():
+            buf = self._cfg_buf = torch.empty(shape, dtype=latents.dtype, device=latents.device,
+                                              memory_format=torch.channels_last)
+        buf.view(n, *latents.shape).copy_(latents)
+        return buf
+
+    def _sample_noise(self, latents: torch.Tensor):
+        """draw the SDS noise into a persistent buffer instead of `torch.randn_like`, it is overwritten every step"""
+        buf = self._noise_buf
+        if buf is None or buf.shape != latents.shape or buf.dtype != latents.dtype or buf.device != latents.device \
+                or buf.is_inference() != torch.is_inference_mode_enabled():
+            buf = self._noise_buf = torch.empty_like(latents)
+        return buf.normal_(generator=self.sds_generator)
+
+    def _unet_forward(self, latent_model_input, t, encoder_hidden_states):
+        latent_model_input = latent_model_input.contiguous(memory_format=torch.channels_last)
+        # torch.compile(mode="reduce-overhead") already replays CUDA graphs
+        if self.cuda_graph_unet and self._device.type == "cuda" and not is_compiled_module(self.unet):
+            key = (latent_model_input.shape, latent_model_input.dtype, t.shape,
+                   encoder_hidden_states.shape, encoder_hidden_states.dtype, torch.is_autocast_enabled(),
+                   torch.is_inference_mode_enabled())
+            if key not in self._unet_graphs:
+                self._unet_graphs[key] = UNetCUDAGraph(self.unet, latent_model_input, t, encoder_hidden_states)
+            return self._unet_graphs[key](latent_model_input, t, encoder_hidden_states)
+        if is_compiled_module(self.unet):
+            # feed the CUDA graphs of torch.compile(mode="reduce-overhead") from stable storage
+            latent_model_input, t, encoder_hidden_states = self._static_unet_inputs(
+                latent_model_input, t, encoder_hidden_states)
+        return self.unet(latent_model_input, t, encoder_hidden_states=encoder_hidden_states).sample
+
+    def _static_unet_inputs(self, *inputs):
+        """copy the U-Net inputs into persistent buffers, keyed by shapes and dtypes like the CUDA graphs"""
+        key = tuple((x.shape, x.dtype) for x in inputs) + (torch.is_inference_mode_enabled(),)
+        if key not in self._unet_static:
+            self._unet_static[key] = tuple(torch.empty_like(x) for x in inputs)
+        static_inputs = self._unet_static[key]
+        for static, x in zip(static_inputs, inputs):
+            static.copy_(x)
+        return static_inputs
+
+    @property
+    def _use_autocast(self):
+        return self.autocast_dtype is not None and self._device.type == "cuda"
+
+    def _autocast(self):
+        return torch.autocast(device_type="cuda", dtype=self.autocast_dtype or torch.float16,
+                              enabled=self._use_autocast)
+
+    # not inference mode, the `output_type="latent"` result may be optimized by SDS afterwards
     @torch.no_grad()
     def __call__(
             self,
@@ -95,7 +313,8 @@ class LSDSPipeline(StableDiffusionPipeline):
                 tensor will ge generated by sampling using the supplied random `generator`.
             output_type (`str`, *optional*, defaults to `"pil"`):
                 The output format of the generate image. Choose between
-                [PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image` or `np.array`.
+                [PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image`, `np.array` or `"latent"`, which
+                returns the denoised latents without decoding them.
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] instead of a
                 plain tuple.
@@ -139,10 +358,7 @@ class LSDSPipeline(StableDiffusionPipeline):
         timesteps = self.scheduler.timesteps
 
         # 5. Prepare latent variables
-        try:
-            num_channels_latents = self.unet.config.in_channels
-        except Exception or Warning:
-            num_channels_latents = self.unet.in_channels
+        num_channels_latents = self._num_channels_latents
 
         latents = self.prepare_latents(
             batch_size * num_images_per_prompt,
@@ -163,8 +379,9 @@ class LSDSPipeline(StableDiffusionPipeline):
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
                 # expand the latents if we are doing classifier free guidance
-                latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
+                latent_model_input = self._cfg_input(latents) if do_classifier_free_guidance else latents
                 latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
+                latent_model_input = latent_model_input.contiguous(memory_format=torch.channels_last)
 
                 # predict the noise residual
                 noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
@@ -184,6 +401,12 @@ class LSDSPipeline(StableDiffusionPipeline):
                         callback(i, t, latents)
 
         # 8. Post-processing
+        # the latents are returned as is, e.g. as the starting point of SDS, skip the vae decoding
+        if output_type == "latent":
+            if not return_dict:
+                return (latents, None)
+            return StableDiffusionPipelineOutput(images=latents, nsfw_content_detected=None)
+
         image = self.decode_latents(latents)
 
         # image = self.vae.decode(latents / self.vae.config.scaling_factor, return_dict=False)[0]
@@ -205,10 +428,13 @@ class LSDSPipeline(StableDiffusionPipeline):
 
     def encode_(self, images):
         images = (2 * images - 1).clamp(-1.0, 1.0)  # images: [B, 3, H, W]
+        images = images.contiguous(memory_format=torch.channels_last)
 
         # encode images
-        latents = self.vae.encode(images).latent_dist.sample()
-        latents = self.vae.config.scaling_factor * latents
+        # record the graph only when the SDS gradient has to reach the images
+        with torch.set_grad_enabled(torch.is_grad_enabled() and images.requires_grad), self._autocast():
+            latents = self.vae.encode(images).latent_dist.sample()
+        latents = self.vae.config.scaling_factor * latents.to(images.dtype)
 
         # scale the initial noise by the standard deviation required by the scheduler
         latents = latents * self.scheduler.init_noise_sigma
@@ -216,45 +442,61 @@ class LSDSPipeline(StableDiffusionPipeline):
         return latents
 
     def x_augment(self, x: torch.Tensor, img_size: int = 512):
-        augment_compose = transforms.Compose([
-            transforms.RandomPerspective(distortion_scale=0.5, p=0.7),
-            transforms.RandomCrop(size=(img_size, img_size), pad_if_needed=True, padding_mode='reflect')
-        ])
-        return augment_compose(x)
-
-    def schedule_timestep(self, step):
+        if img_size not in self._augments:
+            self._augments[img_size] = transforms.Compose([
+                transforms.RandomPerspective(distortion_scale=0.5, p=0.7),
+                transforms.RandomCrop(size=(img_size, img_size), pad_if_needed=True, padding_mode='reflect')
+            ])
+        return self._augments[img_size](x)
+
+    def _parse_t_schedule(self):
         min_step = int(self.num_train_timesteps * self.t_range[0])
         max_step = int(self.num_train_timesteps * self.t_range[1])
         if self.t_schedule == 'randint':
-            t = torch.randint(min_step, max_step + 1, [1], dtype=torch.long, device=self.device)
-        elif re.match(r"max_([\d.]+)_(\d+)", self.t_schedule):
+            return 'randint', min_step, max_step, None, None
+        elif _MAX_T_SCHEDULE.match(self.t_schedule):
             # Anneal time schedule
             # e.g: t_schedule == 'max_0.5_200'
             # [0.02, 0.98] -> [0.02, 0.5] after 200 steps
-            tag, t_val, step_upd = str(self.t_schedule).split('_')
-            t_val, step_upd = float(t_val), int(step_upd)
-            if step >= step_upd:
-                max_step = int(self.num_train_timesteps * t_val)
-            t = torch.randint(min_step, max_step + 1, [1], dtype=torch.long, device=self.device)
-        elif re.match(r"min_([\d.]+)_(\d+)", self.t_schedule):
+            kind = 'max'
+        elif _MIN_T_SCHEDULE.match(self.t_schedule):
             # Anneal time schedule
             # e.g: t_schedule == 'min_0.5_200'
             # [0.02, 0.98] -> [0.5, 0.98] after 200 steps
-            tag, t_val, step_upd = str(self.t_schedule).split('_')
-            t_val, step_upd = float(t_val), int(step_upd)
-            if step >= step_upd:
-                min_step = int(self.num_train_timesteps * t_val)
-            t = torch.randint(min_step, max_step + 1, [1], dtype=torch.long, device=self.device)
+            kind = 'min'
         else:
             raise NotImplementedError(f"{self.t_schedule} is not support.")
-        return t
+        tag, t_val, step_upd = str(self.t_schedule).split('_')
+        return kind, min_step, max_step, int(self.num_train_timesteps * float(t_val)), int(step_upd)
+
+    def schedule_timestep(self, step, k: int = 1):
+        # `t_schedule` and `t_range` are parsed once, and again only if they are changed
+        key = (self.t_schedule, tuple(self.t_range), self.num_train_timesteps)
+        if self._t_sched is None or self._t_sched[0] != key:
+            self._t_sched = (key, *self._parse_t_schedule())
+        _, kind, min_step, max_step, t_step, step_upd = self._t_sched
+
+        if kind == 'max' and step >= step_upd:
+            max_step = t_step
+        elif kind == 'min' and step >= step_upd:
+            min_step = t_step
+        return torch.empty([k], dtype=torch.long, device=self._device).random_(min_step, max_step + 1)
 
     def get_text_embeddings(self, 
                             prompt, 
                             negative_prompt, 
                             batch_size = 2, 
                             guidance_scale = 100):
-        
+        # `guidance_scale` may be a 0-d tensor, which hashes by identity, so the flag is a plain bool
+        # the embeddings are cast to the autocast dtype, so it is part of the key
+        key = (_prompt_key(prompt), _prompt_key(negative_prompt), batch_size, bool(guidance_scale > 1.),
+               self.autocast_dtype if self._use_autocast else None)
+        if key not in self._text_emb_cache:
+            self._text_emb_cache[key] = self._get_text_embeddings(prompt, negative_prompt, batch_size, guidance_scale)
+        return self._text_emb_cache[key]
+
+    @torch.no_grad()
+    def _get_text_embeddings(self, prompt, negative_prompt, batch_size, guidance_scale):
         ######## text condition 
         text_input = self.tokenizer(
             prompt,
@@ -263,38 +505,51 @@ class LSDSPipeline(StableDiffusionPipeline):
             return_tensors="pt"
         )
 
-        text_embeddings = self.text_encoder(text_input.input_ids.to(self.device))[0]
+        text_embeddings = self.text_encoder(text_input.input_ids.to(self._device))[0]
+        if self._use_autocast:
+            text_embeddings = text_embeddings.to(self.autocast_dtype)
         
         # unconditional embedding for classifier free guidance
         if guidance_scale > 1.:
-            max_length = text_input.input_ids.shape[-1]
             if negative_prompt is None:
-                negative_prompt = [""] * batch_size
-
-            # uc_text = "ugly, tiling, poorly drawn hands, poorly drawn feet, body out of frame, cut off, low contrast, underexposed, distorted face"
-            unconditional_input = self.tokenizer(
-                negative_prompt,
-                padding="max_length",
-                max_length=77,
-                return_tensors="pt"
-            )
-            # unconditional_input.input_ids = unconditional_input.input_ids[:, 1:]
-            unconditional_embeddings = self.text_encoder(unconditional_input.input_ids.to(self.device))[0]
+                key = (batch_size, self.autocast_dtype if self._use_autocast else None)
+                if key not in self._uncond_emb_cache:
+                    self._uncond_emb_cache[key] = self._encode_uncond([""] * batch_size)
+                unconditional_embeddings = self._uncond_emb_cache[key]
+            else:
+                unconditional_embeddings = self._encode_uncond(negative_prompt)
             text_embeddings = torch.cat([unconditional_embeddings, text_embeddings], dim=0)
             
         return text_embeddings
 
+    @torch.no_grad()
+    def _encode_uncond(self, negative_prompt):
+        # uc_text = "ugly, tiling, poorly drawn hands, poorly drawn feet, body out of frame, cut off, low contrast, underexposed, distorted face"
+        unconditional_input = self.tokenizer(
+            negative_prompt,
+            padding="max_length",
+            max_length=77,
+            return_tensors="pt"
+        )
+        # unconditional_input.input_ids = unconditional_input.input_ids[:, 1:]
+        unconditional_embeddings = self.text_encoder(unconditional_input.input_ids.to(self._device))[0]
+        if self._use_autocast:
+            unconditional_embeddings = unconditional_embeddings.to(self.autocast_dtype)
+        return unconditional_embeddings
+
     def predict_noise(self, latents, noise, time_step, embeddings, do_classifier_free_guidance = True, guidance_scale = 100):
-        DEVICE = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
         # predict the noise residual with unet, stop gradient
-        with torch.no_grad():
-            # add noise
-            latents_noisy = self.scheduler.add_noise(latents, noise, time_step)
-            if guidance_scale > 1: 
-                latent_model_input = torch.cat([latents_noisy] * 2).to(self.device)
-            else: 
-                latent_model_input = latents_noisy.to(self.device)
-            noise_pred = self.unet(latent_model_input, time_step, encoder_hidden_states=embeddings).sample      
+        with torch.inference_mode():
+            with self._autocast():
+                # add noise
+                latents_noisy = self.scheduler.add_noise(latents, noise, time_step)
+                if guidance_scale > 1: 
+                    latent_model_input = self._cfg_input(latents_noisy)
+                else: 
+                    latent_model_input = latents_noisy
+                noise_pred = self._unet_forward(latent_model_input, time_step, embeddings)
+            # keep the guidance and the gradient in fp32
+            noise_pred = noise_pred.float()
                     
             # perform guidance (high scale from paper!)
             if do_classifier_free_guidance:
@@ -305,9 +560,12 @@ class LSDSPipeline(StableDiffusionPipeline):
 
     def encode2latent(self, images):
         images = (2 * images - 1).clamp(-1.0, 1.0)  # images: [B, 3, H, W]
+        images = images.contiguous(memory_format=torch.channels_last)
         # encode imagesf
-        latents = self.vae.encode(images).latent_dist.sample()
-        latents = self.vae.config.scaling_factor * latents
+        # record the graph only when the SDS gradient has to reach the images
+        with torch.set_grad_enabled(torch.is_grad_enabled() and images.requires_grad), self._autocast():
+            latents = self.vae.encode(images).latent_dist.sample()
+        latents = self.vae.config.scaling_factor * latents.to(images.dtype)
         return latents
     
     # def get_interactive_value(self, max, min, step, total_step):
@@ -344,34 +602,41 @@ class LSDSPipeline(StableDiffusionPipeline):
                 alpha_range: str = '00',
                 gs_range: str = '00',
                 start_latent_interpolation: int = 300, 
-                total_step: int = 1000): 
+                total_step: int = 1000,
+                text_embeddings: torch.Tensor = None): 
 
-        self.num_train_timesteps = self.scheduler.config.num_train_timesteps
-        alphas = self.scheduler.alphas_cumprod.to(self.device)  # for convenience
+        self._prepare_sds()
+        alphas = self._alphas_cumprod
         pred_rgb = self.x_augment(pred_rgb, im_size)  # input augmentation
         batch_size = pred_rgb.shape[0]
         
         # encode image into latents with vae, requires grad!
-        pred_rgb_ = F.interpolate(pred_rgb, (512, 512), mode='bilinear', align_corners=False)
-        latent_list = [self.encode2latent(pred_rgb_[i].unsqueeze(0)) for i in range(batch_size)]
-        latents = torch.cat(latent_list, dim=0)
-        latents = latents.to(self.device)
+        if pred_rgb.shape[-2:] != (512, 512):
+            pred_rgb_ = F.interpolate(pred_rgb, (512, 512), mode='bilinear', align_corners=False,
+                                      antialias=pred_rgb.shape[-1] > 512)
+        else:
+            pred_rgb_ = pred_rgb
+        latents = self.encode2latent(pred_rgb_)
 
-        noise = torch.randn_like(latents)
+        noise = self._sample_noise(latents)
         
         t = self.schedule_timestep(step)
-        text_embeddings = self.get_text_embeddings(prompt = prompts, 
-                                                   negative_prompt= negative_prompts, 
-                                                   batch_size = batch_size, 
-                                                   guidance_scale= guidance_scale)
+        if text_embeddings is None:
+            text_embeddings = self.get_text_embeddings(prompt = prompts, 
+                                                       negative_prompt= negative_prompts, 
+                                                       batch_size = batch_size, 
+                                                       guidance_scale= guidance_scale)
 
+        w = (1 - alphas[t])
         if loss_type == 0: 
             noise_pred = self.predict_noise(latents= latents, 
                                 noise = noise,
                                 time_step= t, 
                                 embeddings= text_embeddings, 
+                                do_classifier_free_guidance= False,
                                 guidance_scale= 100) # vectorfusion은 guidance scale이 100 
-            noise_final = noise_pred.clone()
+            noise_pred_uncond, noise_pred_pos = noise_pred.chunk(2)
+            grad = _sds_grad(noise_pred_uncond, noise_pred_pos, noise, w, 100., float(grad_scale), self.nan_guard)
         elif loss_type == 1: 
             
             if alpha_range != '00':
@@ -384,30 +649,26 @@ class LSDSPipeline(StableDiffusionPipeline):
             
             # print(alpha_value, gs_value)
             
-            noise_pred = self.predict_noise(latents= latents, 
-                                            noise = noise,
-                                            time_step= t, 
-                                            embeddings= text_embeddings, 
-                                            guidance_scale= gs_value)
-            
-            noise_pred_o = self.predict_noise(latents= latents_o, 
-                                              noise = noise, 
-                                              time_step= t, 
-                                              embeddings= text_embeddings, 
-                                              guidance_scale= gs_value)
+            # latents and latents_o share t and noise, so predict both with a single U-Net call
+            if gs_value > 1:
+                uncond_embeddings, cond_embeddings = text_embeddings.chunk(2)
+                embeddings = torch.cat([uncond_embeddings, uncond_embeddings, cond_embeddings, cond_embeddings])
+            else:
+                embeddings = text_embeddings.repeat(2, 1, 1)
+            noise_pred_cat = self.predict_noise(latents= torch.cat([latents, latents_o]), 
+                                                noise = noise.repeat(2, 1, 1, 1),
+                                                time_step= t, 
+                                                embeddings= embeddings, 
+                                                guidance_scale= gs_value)
+            noise_pred, noise_pred_o = noise_pred_cat.chunk(2)
 
             if step > start_latent_interpolation: 
                 noise_final = (1- alpha_value) * noise_pred + alpha_value * noise_pred_o
             else: 
-                noise_final = noise_pred.clone()
-                
-            
-        w = (1 - alphas[t])
-        grad = grad_scale * w * (noise_final - noise)
-        grad = torch.nan_to_num(grad)
+                noise_final = noise_pred
+            grad = _sds_grad_no_cfg(noise_final, noise, w, float(grad_scale), self.nan_guard)
 
-        # since we omitted an item in grad, we need to use the custom function to specify the gradient
-        loss = SpecifyGradient.apply(latents, grad)
+        loss = _sds_loss(latents, grad)
  
         return loss, grad.mean(), t
 
@@ -423,55 +684,63 @@ class LSDSPipeline(StableDiffusionPipeline):
                                     as_latent: bool = False,
                                     grad_scale: float = 1,
                                     t_range: Union[List[float], Tuple[float]] = (0.05, 0.95), 
-                                    is_guided: bool = False):
+                                    is_guided: bool = False,
+                                    text_embeddings: torch.Tensor = None):
 
-        alphas = self.scheduler.alphas_cumprod.to(self.device)  # for convenience
+        self._prepare_sds()
+        alphas = self._alphas_cumprod
 
         # input augmentation
         pred_rgb_a = self.x_augment(pred_rgb, im_size)
 
         # the input is intercepted to im_size x im_size and then fed to the vae
         if as_latent:
-            latents = F.interpolate(pred_rgb_a, (64, 64), mode='bilinear', align_corners=False) * 2 - 1
+            if pred_rgb_a.shape[-2:] != (64, 64):
+                pred_rgb_a = F.interpolate(pred_rgb_a, (64, 64), mode='bilinear', align_corners=False)
+            latents = pred_rgb_a * 2 - 1
         else:
             # encode image into latents with vae, requires grad!
             latents = self.encode_(pred_rgb_a)
 
         #  Encode input prompt
         num_images_per_prompt = 1  # the number of images to generate per prompt
-        do_classifier_free_guidance = guidance_scale > 1.0
-        text_embeddings = self._encode_prompt(
-            prompt, self.device, num_images_per_prompt,
-            do_classifier_free_guidance,
-            negative_prompt=negative_prompt,
-        )
+        do_classifier_free_guidance = bool(guidance_scale > 1.0)
+        if text_embeddings is None:
+            # the prompts are fixed during an SDS run, encode them only once (same key as the guided SDS, one timestep)
+            key = ("_encode_prompt", _prompt_key(prompt), _prompt_key(negative_prompt), do_classifier_free_guidance, 1)
+            if key not in self._text_emb_cache:
+                self._text_emb_cache[key] = self._encode_prompt(
+                    prompt, self._device, num_images_per_prompt,
+                    do_classifier_free_guidance,
+                    negative_prompt=negative_prompt,
+                ).contiguous()
+            text_embeddings = self._text_emb_cache[key]
 
         # timestep ~ U(0.05, 0.95) to avoid very high/low noise level
         # t = torch.randint(min_step, max_step + 1, [1], dtype=torch.long, device=self.device)
         t = self.schedule_timestep(step)
         
+        noise = self._sample_noise(latents)
         # predict the noise residual with unet, stop gradient
-        with torch.no_grad():
+        with torch.inference_mode(), self._autocast():
             # add noise
-            noise = torch.randn_like(latents)
             latents_noisy = self.scheduler.add_noise(latents, noise, t)
             # pred noise
-            latent_model_input = torch.cat([latents_noisy] * 2) if do_classifier_free_guidance else latents_noisy
-            noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
+            latent_model_input = self._cfg_input(latents_noisy) if do_classifier_free_guidance else latents_noisy
+            noise_pred = self._unet_forward(latent_model_input, t, text_embeddings)
+        noise_pred = noise_pred.float()
 
+        # w(t), sigma_t^2
+        w = (1 - alphas[t])
         # perform guidance (high scale from paper!)
         if do_classifier_free_guidance:
             noise_pred_uncond, noise_pred_pos = noise_pred.chunk(2)
-            noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_pos - noise_pred_uncond)
-
-        # w(t), sigma_t^2
-        w = (1 - alphas[t])
-        grad = grad_scale * w * (noise_pred - noise)
-        
-        grad = torch.nan_to_num(grad)
+            grad = _sds_grad(noise_pred_uncond, noise_pred_pos, noise, w, float(guidance_scale), float(grad_scale),
+                             self.nan_guard)
+        else:
+            grad = _sds_grad_no_cfg(noise_pred, noise, w, float(grad_scale), self.nan_guard)
 
-        # since we omitted an item in grad, we need to use the custom function to specify the gradient
-        loss = SpecifyGradient.apply(latents, grad)
+        loss = _sds_loss(latents, grad)
  
         return loss, grad.mean(), t
 
@@ -486,9 +755,11 @@ class LSDSPipeline(StableDiffusionPipeline):
                                     guidance_scale: float = 100,
                                     as_latent: bool = False,
                                     grad_scale: float = 1,
-                                    is_sds: bool = False):
-        DEVICE = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-        alphas = self.scheduler.alphas_cumprod.to(self.device)  # for convenience
+                                    is_sds: bool = False,
+                                    text_embeddings: torch.Tensor = None,
+                                    text_embeddings_inv: torch.Tensor = None):
+        self._prepare_sds()
+        alphas = self._alphas_cumprod
         pred_rgb_a = self.x_augment(pred_rgb, im_size)  # input augmentation
 
         # the input is intercepted to im_size x im_size and then fed to the vae
@@ -498,78 +769,61 @@ class LSDSPipeline(StableDiffusionPipeline):
             # encode image into latents with vae, requires grad!
             latents = self.encode_(pred_rgb_a)
 
-        def get_text_embeddings(prompt, negative_prompt, batch_size = 1, guidance_scale = guidance_scale):
-            ######## text condition 
-            text_input = self.tokenizer(
-                prompt,
-                padding="max_length",
-                max_length=77,
-                return_tensors="pt"
-            )
-
-            text_embeddings = self.text_encoder(text_input.input_ids.to(self.device))[0]
-            
-            # unconditional embedding for classifier free guidance
-            if guidance_scale > 1.:
-                max_length = text_input.input_ids.shape[-1]
-                if negative_prompt is None:
-                    negative_prompt = [""] * batch_size
-
-                # uc_text = "ugly, tiling, poorly drawn hands, poorly drawn feet, body out of frame, cut off, low contrast, underexposed, distorted face"
-                unconditional_input = self.tokenizer(
-                    negative_prompt,
-                    padding="max_length",
-                    max_length=77,
-                    return_tensors="pt"
-                )
-                # unconditional_input.input_ids = unconditional_input.input_ids[:, 1:]
-                unconditional_embeddings = self.text_encoder(unconditional_input.input_ids.to(self.device))[0]
-                text_embeddings = torch.cat([unconditional_embeddings, text_embeddings], dim=0)
-                
-            return text_embeddings
-        
-        def predict_noise(latents, time_step, embeddings, do_classifier_free_guidance = True, guidance_scale = guidance_scale):
-            # predict the noise residual with unet, stop gradient
-            with torch.no_grad():
-                # add noise
-                noise = torch.randn_like(latents)
-                latents_noisy = self.scheduler.add_noise(latents, noise, t)
-
-                if guidance_scale > 1: 
-                    latent_model_input = torch.cat([latents_noisy] * 2).to(self.device)
-                else: 
-                    latent_model_input = latents_noisy.to(self.device)
-
-                noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=embeddings).sample      
-                     
-                # perform guidance (high scale from paper!)
-                if do_classifier_free_guidance:
-                    noise_pred_uncon, noise_pred_con = noise_pred.chunk(2, dim=0)
-                    noise_pred = noise_pred_uncon + guidance_scale * (noise_pred_con - noise_pred_uncon)
-            
-            return noise_pred 
-        
         t = self.schedule_timestep(step)
+        t_pre = (t - 20).clamp(min=0)
+        do_classifier_free_guidance = guidance_scale > 1.
         
-        text_embeddings = get_text_embeddings(prompt = prompt, negative_prompt= negative_prompt)
-        noise_pred = predict_noise(latents= latents, time_step= t, embeddings= text_embeddings)
-        noise_pred_pre = predict_noise(latents= latents, time_step = t - 20, embeddings= text_embeddings)
-        
+        if text_embeddings is None:
+            text_embeddings = self.get_text_embeddings(prompt = prompt, negative_prompt= negative_prompt,
+                                                       batch_size = 1, guidance_scale = guidance_scale)
         # inv 
-        text_embeddings_inv = get_text_embeddings(prompt = ref_prompt, negative_prompt= negative_prompt)
-        noise_pred_inv = predict_noise(latents=start_code, time_step= t, embeddings= text_embeddings_inv)
-        noise_pred_pre_inv = predict_noise(latents=start_code, time_step= t - 20, embeddings= text_embeddings_inv)
-        
-        
+        if text_embeddings_inv is None:
+            text_embeddings_inv = self.get_text_embeddings(prompt = ref_prompt, negative_prompt= negative_prompt,
+                                                           batch_size = 1, guidance_scale = guidance_scale)
+
+        # latents and start_code at t and t - 20 are predicted by a single U-Net call,
+        # the batch is ordered as [latents(t), start_code(t), latents(t - 20), start_code(t - 20)]
+        batch_size = latents.shape[0]
+        latents_stack = torch.cat([latents, start_code, latents, start_code])
+        t_stack = torch.cat([t, t, t_pre, t_pre]).repeat_interleave(batch_size)
+        if do_classifier_free_guidance:
+            uncond_embeddings, cond_embeddings = text_embeddings.chunk(2)
+            uncond_embeddings_inv, cond_embeddings_inv = text_embeddings_inv.chunk(2)
+            uncond_embeddings = torch.cat([uncond_embeddings, uncond_embeddings_inv])
+            cond_embeddings = torch.cat([cond_embeddings, cond_embeddings_inv])
+            embeddings = torch.cat([uncond_embeddings, uncond_embeddings, cond_embeddings, cond_embeddings])
+        else:
+            embeddings = torch.cat([text_embeddings, text_embeddings_inv]).repeat(2, 1, 1)
+
+        # a single noise buffer is shared by the four predictions
+        noise = self._sample_noise(latents_stack)
+        # predict the noise residual with unet, stop gradient
+        with torch.inference_mode(), self._autocast():
+            # add noise
+            latents_noisy = self.scheduler.add_noise(latents_stack, noise, t_stack)
+            if do_classifier_free_guidance:
+                latent_model_input, t_input = self._cfg_input(latents_noisy), t_stack.repeat(2)
+            else:
+                latent_model_input, t_input = latents_noisy, t_stack
+            noise_pred = self._unet_forward(latent_model_input, t_input, embeddings)
+        noise_pred = noise_pred.float()
+
         w = (1 - alphas[t])
-        grad = grad_scale * w * (noise_pred_pre - noise_pred)
-        grad_inv = grad_scale * w * (noise_pred_pre_inv - noise_pred_inv)
+        if do_classifier_free_guidance:
+            noise_pred_uncond, noise_pred_pos = noise_pred.chunk(2)
+            noise_pred_uncond, noise_pred_uncond_pre = noise_pred_uncond.chunk(2)
+            noise_pred_pos, noise_pred_pos_pre = noise_pred_pos.chunk(2)
+            noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_pos - noise_pred_uncond)
+            # the guidance of the "pre" predictions is fused into the gradient
+            grad = _sds_grad(noise_pred_uncond_pre, noise_pred_pos_pre, noise_pred,
+                             w, float(guidance_scale), float(grad_scale), self.nan_guard)
+        else:
+            noise_pred, noise_pred_pre = noise_pred.chunk(2)
+            grad = _sds_grad_no_cfg(noise_pred_pre, noise_pred, w, float(grad_scale), self.nan_guard)
+        grad, grad_inv = grad.chunk(2)
         grad = grad + grad_inv
-        
-        grad = torch.nan_to_num(grad)
 
-        # since we omitted an item in grad, we need to use the custom function to specify the gradient
-        loss = SpecifyGradient.apply(latents, grad)
+        loss = _sds_loss(latents, grad)
  
         return loss, grad.mean(), t
 
@@ -586,9 +840,11 @@ class LSDSPipeline(StableDiffusionPipeline):
                                     guidance_scale: float = 100,
                                     as_latent: bool = False,
                                     grad_scale: float = 1,
-                                    t_range: Union[List[float], Tuple[float]] = (0.05, 0.95)):
+                                    t_range: Union[List[float], Tuple[float]] = (0.05, 0.95),
+                                    log_grad: bool = True):
 
-        alphas = self.scheduler.alphas_cumprod.to(self.device)  # for convenience
+        self._prepare_sds()
+        alphas = self._alphas_cumprod
 
         # input augmentation
         pred_rgb_a = self.x_augment(pred_rgb, im_size)
@@ -599,59 +855,120 @@ class LSDSPipeline(StableDiffusionPipeline):
         else:
             # encode image into latents with vae, requires grad!
             latents = self.encode_(pred_rgb_a)
+        # NHWC latents, matching the channels_last U-Net
+        latents = latents.contiguous(memory_format=torch.channels_last)
+        # a target on the host would be copied every step, and it must not pin the graph it was computed by
+        latent_ni = latent_ni.to(latents.device, non_blocking=True, memory_format=torch.channels_last).detach()
 
         #  Encode input prompt
         num_images_per_prompt = 1  # the number of images to generate per prompt
-        do_classifier_free_guidance = guidance_scale > 1.0
-        text_embeddings = self._encode_prompt(
-            prompt, self.device, num_images_per_prompt,
-            do_classifier_free_guidance,
-            negative_prompt=negative_prompt,
-        )
+        # the guidance is a no-op at guidance_scale ~= 1, only the positive branch is evaluated then
+        do_classifier_free_guidance = bool(guidance_scale > 1.0 + 1e-3)
+        # `sds_num_timesteps` timesteps are tiled along the batch, their gradients are averaged
+        num_t = self.sds_num_timesteps
+        # the prompts are fixed during an SDS run, encode and tile them only once,
+        # the U-Net then gets the same contiguous [uncond, cond] blob every step
+        key = ("_encode_prompt", _prompt_key(prompt), _prompt_key(negative_prompt), do_classifier_free_guidance, num_t)
+        if key not in self._text_emb_cache:
+            text_embeddings = self._encode_prompt(
+                prompt, self._device, num_images_per_prompt,
+                do_classifier_free_guidance,
+                negative_prompt=negative_prompt,
+            )
+            if do_classifier_free_guidance:
+                uncond_embeddings, cond_embeddings = text_embeddings.chunk(2)
+                text_embeddings = torch.cat([uncond_embeddings.repeat(num_t, 1, 1),
+                                             cond_embeddings.repeat(num_t, 1, 1)])
+            else:
+                text_embeddings = text_embeddings.repeat(num_t, 1, 1)
+            self._text_emb_cache[key] = text_embeddings.contiguous()
+        embeddings = self._text_emb_cache[key]
     
         # timestep ~ U(0.05, 0.95) to avoid very high/low noise level
         # t = torch.randint(min_step, max_step + 1, [1], dtype=torch.long, device=self.device)
-        t = self.schedule_timestep(step)
-
+        t = self.schedule_timestep(step, k=num_t)
+        t_batch = t.repeat_interleave(latents.shape[0])
+
+        latents_t = latents.detach().repeat(num_t, 1, 1, 1).contiguous(memory_format=torch.channels_last)
+        # `t` stays on the device, so indexing the schedule does not sync with the host,
+        # the terms follow the latents dtype like `scheduler.add_noise`
+        sqrt_alpha_prod = self._sqrt_alphas_cumprod.index_select(0, t_batch).view(-1, 1, 1, 1)
+        sqrt_alpha_prod = sqrt_alpha_prod.to(latents_t.dtype)
+        sqrt_one_minus_alpha_prod = self._sqrt_one_minus_alphas_cumprod.index_select(0, t_batch).view(-1, 1, 1, 1)
+        sqrt_one_minus_alpha_prod = sqrt_one_minus_alpha_prod.to(latents_t.dtype)
+        noise = self._sample_noise(latents_t)
         # predict the noise residual with unet, stop gradient
-        with torch.no_grad():
+        with torch.inference_mode():
             ## add noise
             # original 
-            noise = torch.randn_like(latents)
-            latents_noisy = self.scheduler.add_noise(latents, noise, t)
-            latent_model_input = torch.cat([latents_noisy] * 2) if do_classifier_free_guidance else latents_noisy
-            noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
-
-        # perform guidance (high scale from paper!)
-        if do_classifier_free_guidance:
-            noise_pred_uncond, noise_pred_pos = noise_pred.chunk(2)
-            noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_pos - noise_pred_uncond)
+            latents_noisy = _add_noise(latents_t, noise, sqrt_alpha_prod, sqrt_one_minus_alpha_prod)
+            if do_classifier_free_guidance:
+                latent_model_input, t_input = self._cfg_input(latents_noisy), t_batch.repeat(2)
+            else:
+                latent_model_input, t_input = latents_noisy, t_batch
+            # channels_last input for the compiled U-Net
+            with self._autocast():
+                noise_pred = self._unet_forward(latent_model_input, t_input, embeddings)
+        # keep the guidance and the gradient in fp32
+        noise_pred = noise_pred.float()
 
         # w(t), sigma_t^2
         # epsilon_ni = (latents_noisy - alphas[t] * latent_ni) / (1 - alphas[t])
-        w = (1 - alphas[t])
+        w = (1 - alphas.index_select(0, t_batch)).view(-1, 1, 1, 1)
+        latent_ni = latent_ni.repeat(num_t, 1, 1, 1) if num_t > 1 else latent_ni
         # grad = grad_scale * w * (noise_pred - (latents_noisy + latent_ni)) 
-        grad = grad_scale * w * (noise_pred - latent_ni)
-        grad = torch.nan_to_num(grad)
+        # perform guidance (high scale from paper!)
+        if do_classifier_free_guidance:
+            noise_pred_uncond, noise_pred_pos = noise_pred.chunk(2)
+            grad = _sds_grad(noise_pred_uncond, noise_pred_pos, latent_ni, w, float(guidance_scale), float(grad_scale),
+                             self.nan_guard)
+        else:
+            grad = _sds_grad_no_cfg(noise_pred, latent_ni, w, float(grad_scale), self.nan_guard)
+        grad = grad.view(num_t, *latents.shape).mean(dim=0)
 
-        # since we omitted an item in grad, we need to use the custom function to specify the gradient
-        loss = SpecifyGradient.apply(latents, grad)
+        loss = _sds_loss(latents, grad)
  
-        return loss, grad.mean(), t
+        # the mean of grad is a full reduction, callers that do not log it can opt out
+        grad_mean = grad.mean() if log_grad else torch.zeros((), device=grad.device)
+        return loss, grad_mean, t
     
 
-class SpecifyGradient(torch.autograd.Function):
-
-    @staticmethod
-    @custom_fwd
-    def forward(ctx, input_tensor, gt_grad):
-        ctx.save_for_backward(gt_grad)
-        # we return a dummy value 1, which will be scaled by amp's scaler so we get the scale in backward.
-        return torch.ones([1], device=input_tensor.device, dtype=input_tensor.dtype)
-
-    @staticmethod
-    @custom_bwd
-    def backward(ctx, grad_scale):
-        gt_grad, = ctx.saved_tensors
-        gt_grad = gt_grad * grad_scale
-        return gt_grad, None
\ No newline at end of file
+class UNetCUDAGraph:
+    """
+    Capture the U-Net forward of a fixed input shape into a CUDA graph, the inputs are copied into
+    static tensors before each replay. Must be called under `torch.no_grad()` or `torch.inference_mode()`.
+    """
+
+    def __init__(self, unet, sample, timestep, encoder_hidden_states, n_warmup: int = 3):
+        self.static_sample = sample.clone()
+        self.static_timestep = timestep.clone()
+        self.static_embeddings = encoder_hidden_states.clone()
+
+        # autocast must not cache the casted weights during capture
+        autocast = torch.autocast(device_type="cuda",
+                                  dtype=torch.get_autocast_gpu_dtype(),
+                                  enabled=torch.is_autocast_enabled(),
+                                  cache_enabled=False)
+
+        # warmup on a side stream before capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), autocast:
+            for _ in range(n_warmup):
+                self._forward(unet)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph), autocast:
+            self.static_output = self._forward(unet)
+
+    def _forward(self, unet):
+        return unet(self.static_sample, self.static_timestep, encoder_hidden_states=self.static_embeddings).sample
+
+    def __call__(self, sample, timestep, encoder_hidden_states):
+        self.static_sample.copy_(sample)
+        self.static_timestep.copy_(timestep)
+        self.static_embeddings.copy_(encoder_hidden_states)
+        self.graph.replay()
+        # the static output is overwritten by the next replay
+        return self.static_output.clone()